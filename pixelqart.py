@@ -1,22 +1,131 @@
 import argparse
 import base64
+import binascii
+import functools
 import io
 import itertools
+import multiprocessing
 import os
-import random
+import re
+import signal
 import tempfile
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
-from threading import Event
-from typing import IO, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from concurrent.futures.process import BrokenProcessPool
+from queue import Empty, Full
+from threading import Event, Lock, Semaphore
+from typing import IO, Deque, List, NamedTuple, Tuple
 from urllib.parse import parse_qs, quote, urlparse
 
+import numpy as np
 import requests
+import zxingcpp
 from PIL import Image
-from pyzbar.pyzbar import decode as decode_barcode
+from requests.adapters import HTTPAdapter
+from turbojpeg import TJPF_GRAY, TJSAMP_GRAY, TurboJPEG
+from urllib3.util.retry import Retry
 
 QRCODE_SIZE = (41, 41)  # QR Code v6
 QART_MARGIN = 4
 
+# QArt responds with a PNG image embedded in a data URL.
+PNG_DATA_URL_PATTERN = re.compile(rb'data:image/png;base64,([A-Za-z0-9+/=]+)')
+
+# Shared by all network threads to reuse keep-alive connections. main()
+# mounts an adapter sized for the number of network threads.
+session = requests.Session()
+
+
+# Recently tried (mask, orient, seed) triplets shared by all network threads.
+MAX_TRIED = 100_000
+_tried: 'OrderedDict[Tuple[int, int, int], None]' = OrderedDict()
+_tried_lock = Lock()
+
+
+def mark_tried(mask: int, orient: int, seed: int) -> bool:
+    """Remembers a trial. Returns ``False`` if it has been tried recently."""
+    key = (mask, orient, seed)
+    with _tried_lock:
+        if key in _tried:
+            return False
+        _tried[key] = None
+        if len(_tried) > MAX_TRIED:
+            _tried.popitem(last=False)
+    return True
+
+
+class Trial(NamedTuple):
+    """A QR Code generated by QArt, waiting to be decoded."""
+
+    mask: int
+    orient: int
+    seed: int
+    url: str
+    png: bytes
+
+
+class TrialQueue:
+    """A bounded queue of trials made of one deque per consumer. Producers
+    deal trials to the deques in turn. A consumer takes the newest trial from
+    its own deque and, when that is empty, steals the oldest trial from
+    another consumer's deque.
+    """
+
+    def __init__(self, consumers: int, maxsize: int) -> None:
+        self._deques: List[Deque[Trial]] = [deque() for _ in range(consumers)]
+        self._turn = itertools.count()
+        self._slots = Semaphore(maxsize)
+        self._items = Semaphore(0)
+
+    def put(self, trial: Trial, timeout: float) -> None:
+        if not self._slots.acquire(timeout=timeout):
+            raise Full
+        i = next(self._turn) % len(self._deques)
+        self._deques[i].append(trial)
+        self._items.release()
+
+    def get(self, consumer: int, timeout: float) -> Trial:
+        if not self._items.acquire(timeout=timeout):
+            raise Empty
+
+        # A trial is guaranteed to be in one of the deques. Look at the own
+        # deque first, then at the others.
+        n = len(self._deques)
+        while True:
+            for i in range(n):
+                d = self._deques[(consumer + i) % n]
+                try:
+                    trial = d.pop() if i == 0 else d.popleft()
+                except IndexError:
+                    continue
+                self._slots.release()
+                return trial
+
+
+# Shared by all decodes. Only QR Codes are interesting.
+read_qrcodes = functools.partial(zxingcpp.read_barcodes,
+                                 formats=zxingcpp.BarcodeFormat.QRCode)
+
+
+# Shared by all JPEG compressions.
+jpeg = TurboJPEG()
+
+
+def is_qrcode(gray: np.ndarray) -> bool:
+    """Whether the grayscale pixels contain exactly one readable QR Code. Feed
+    grayscale pixels to skip the color conversion inside the decoder.
+    """
+    return len(read_qrcodes(gray)) == 1
+
+
+def _init_worker() -> None:
+    """Warms up the QR Code decoder in a worker process. Ctrl-C is left to the
+    main process, which shuts the workers down.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    is_qrcode(np.full((21, 21), 255, np.uint8))
+
 
 def split_design(design: Image.Image) -> Tuple[Image.Image, Image.Image]:
     """Splits a design image to the desired part and necessary part. The design
@@ -30,72 +139,129 @@ def split_design(design: Image.Image) -> Tuple[Image.Image, Image.Image]:
     NECESSARY_BLACK = (0, 0, 255, 255)    # blue
     NECESSARY_WHITE = (255, 255, 0, 255)  # yellow
 
-    desired = Image.new('RGBA', QRCODE_SIZE)
-    necessary = Image.new('RGBA', QRCODE_SIZE)
+    def pack(rgba: Tuple[int, int, int, int]) -> np.uint32:
+        return np.array(rgba, np.uint8).view(np.uint32)[0]
 
-    desired_pixels = desired.load()
-    necessary_pixels = necessary.load()
+    # Compare each RGBA pixel as a single 32-bit integer.
+    pixels = np.array(design).view(np.uint32)[..., 0]
+    black = (pixels == pack(NECESSARY_BLACK))
+    white = (pixels == pack(NECESSARY_WHITE))
 
-    pixels = design.load()
-    for x, y in itertools.product(range(design.width), range(design.height)):
-        if pixels[x, y] == NECESSARY_BLACK:
-            desired_pixels[x, y] = (0, 0, 0, 255)
-            necessary_pixels[x, y] = (0, 0, 0, 255)
-        elif pixels[x, y] == NECESSARY_WHITE:
-            desired_pixels[x, y] = (255, 255, 255, 255)
-            necessary_pixels[x, y] = (255, 255, 255, 255)
-        else:
-            desired_pixels[x, y] = pixels[x, y]
+    necessary_pixels = np.zeros_like(pixels)
+    necessary_pixels[black] = pack((0, 0, 0, 255))
+    necessary_pixels[white] = pack((255, 255, 255, 255))
+
+    desired_pixels = np.where(black | white, necessary_pixels, pixels)
+
+    shape = (design.height, design.width, 4)
+    desired = Image.fromarray(desired_pixels.view(np.uint8).reshape(shape),
+                              'RGBA')
+    necessary = Image.fromarray(necessary_pixels.view(np.uint8).reshape(shape),
+                                'RGBA')
 
     return desired, necessary
 
 
 def upload_image(filename: str) -> str:
     with open(filename, 'rb') as f:
-        r = requests.post('https://research.swtch.com/qr/draw?upload=1',
-                          files={'image': f}, allow_redirects=False)
+        r = session.post('https://research.swtch.com/qr/draw?upload=1',
+                         files={'image': f}, allow_redirects=False,
+                         timeout=10)
     assert r.status_code == 302
     qs = parse_qs(urlparse(r.headers['Location']).query)
     return qs['i'][0]
 
 
-def search_qrcode(name: str,
-                  href: str,
+def fetch_qrcodes(href: str,
                   uploaded_image_id: str,
-                  necessary: Image.Image,
+                  trials: TrialQueue,
                   stop_event: Event,
-                  stop_if_found: bool,
+                  verbose: bool = False,
                   ) -> None:
-    """Finds a QR Code including a pixel-art. A found QR Code must include the
-    necessary part.
+    """Generates random QR Codes by QArt and puts them into the trials queue.
+    This stage is bound by network I/O.
     """
+    # https://github.com/rsc/swtch/blob/master/qrweb/play.go#L145
+    url_prefix = ('https://research.swtch.com/qr/draw?x=0&y=0&c=0&'
+                  f'i={uploaded_image_id}&'
+                  'v=6&'  # QR Code version (v6 generates 41x41)
+                  'r=1&'  # Random Pixels
+                  'd=0&'  # Data Pixels Only
+                  't=0&'  # Dither (not implemented)
+                  'z=0&'  # Scale of source image
+                  f'u={quote(href, safe="")}&'
+                  )
+    # Only the mask, orient, and seed vary by trial. Escape the percent-encoded
+    # prefix to keep it as is.
+    url_template = (url_prefix.replace('%', '%%') +
+                    'm=%d&'  # Mask pattern (0-7)
+                    'o=%d&'  # Rotation (0-3)
+                    's=%d'   # Random seed (int64)
+                    )
+
+    # Sample (mask, orient, seed) triplets in batches. Each thread owns a
+    # generator.
+    rng = np.random.default_rng()
+    batch: List[Tuple[int, int, int]] = []
+
     while not stop_event.is_set():
-        mask = random.randrange(8)
-        orient = random.randrange(4)
-        seed = random.getrandbits(32)
-
-        # https://github.com/rsc/swtch/blob/master/qrweb/play.go#L145
-        url = ('https://research.swtch.com/qr/draw?x=0&y=0&c=0&'
-               f'i={uploaded_image_id}&'
-               'v=6&'  # QR Code version (v6 generates 41x41)
-               'r=1&'  # Random Pixels
-               'd=0&'  # Data Pixels Only
-               't=0&'  # Dither (not implemented)
-               'z=0&'  # Scale of source image
-               f'u={quote(href, safe="")}&'
-               f'm={mask}&'    # Mask pattern (0-7)
-               f'o={orient}&'  # Rotation (0-3)
-               f's={seed}'     # Random seed (int64)
-               )
-        print(f'Trying: {url}')
+        if not batch:
+            batch = rng.integers([0, 0, 0], [8, 4, 2**32], size=(256, 3),
+                                 dtype=np.int64).tolist()
+        mask, orient, seed = batch.pop()
+        if not mark_tried(mask, orient, seed):
+            continue
+
+        url = url_template % (mask, orient, seed)
+        if verbose:
+            print(f'Trying: {url}')
 
         # Generate a basic QR Code by QArt: https://research.swtch.com/qr/draw
-        r = requests.get(url)
-        _, data, *_ = r.content.decode().split('"')
-        assert data.startswith('data:image/png;base64,')
+        # A failed trial should not stop this thread. Just try another one.
+        try:
+            r = session.get(url, timeout=10)
+            r.raise_for_status()
+            m = PNG_DATA_URL_PATTERN.search(r.content)
+            if m is None:
+                print(f'Failed: {url} (no PNG in the response)')
+                continue
+            png = base64.b64decode(m.group(1))
+        except (requests.RequestException, binascii.Error) as exc:
+            print(f'Failed: {url} ({exc!r})')
+            continue
+        trial = Trial(mask, orient, seed, url, png)
+
+        # Block while the consumers are behind, but keep watching the stop
+        # event.
+        while not stop_event.is_set():
+            try:
+                trials.put(trial, timeout=1)
+            except Full:
+                continue
+            break
 
-        data = data[len('data:image/png;base64,'):]
-        qrcode = Image.open(io.BytesIO(base64.b64decode(data)))
+
+def search_qrcode(name: str,
+                  necessary_pixels: np.ndarray,
+                  necessary_mask: np.ndarray,
+                  trials: TrialQueue,
+                  worker: int,
+                  decode_pool: Executor,
+                  eval_pool: Executor,
+                  stop_event: Event,
+                  stop_if_found: bool,
+                  ) -> None:
+    """Finds a QR Code including a pixel-art among the fetched trials. A found
+    QR Code must include the necessary part, given as grayscale pixels scaled
+    up 4 times and their opaque mask. This stage is bound by CPU.
+    """
+    while not stop_event.is_set():
+        try:
+            mask, orient, seed, url, png = trials.get(worker, timeout=1)
+        except Empty:
+            continue
+
+        qrcode = Image.open(io.BytesIO(png))
 
         # The essential size of the QR Code is 49x49 (41x41 + margin 4px) but
         # it is scaled up 4 times.
@@ -104,28 +270,42 @@ def search_qrcode(name: str,
 
         assert qrcode.width == 4 * size[0]
         assert qrcode.height == 4 * size[1]
-        qrcode = qrcode.resize(size)
 
-        # Paste the necessary part.
-        canvas = Image.new('RGBA', size, (0, 0, 0, 0))
-        canvas.paste(qrcode)
-        canvas.paste(necessary, (QART_MARGIN, QART_MARGIN), mask=necessary)
+        # QR Codes are black and white. Keep only the luminance so that the
+        # decoder takes the pixels as is.
+        gray = np.array(qrcode.convert('L'))
 
-        info = decode_barcode(canvas.resize((canvas.width*2, canvas.height*2)))
-        ok = (len(info) == 1 and info[0].type == 'QRCODE')
+        # Paste the necessary part.
+        inner = gray[4*QART_MARGIN:4*(QART_MARGIN+QRCODE_SIZE[1]),
+                     4*QART_MARGIN:4*(QART_MARGIN+QRCODE_SIZE[0])]
+        inner[necessary_mask] = necessary_pixels[necessary_mask]
+
+        try:
+            ok = decode_pool.submit(is_qrcode, gray).result()
+        except BrokenProcessPool as exc:
+            print(f'Decoder crashed: {exc!r}')
+            stop_event.set()
+            break
         if not ok:
             continue
 
         # Found!
         print(f'Found: {url}')
 
-        # Evaluation is CPU-intensive.
-        with ProcessPoolExecutor(1) as ex:
-            fut = ex.submit(eval_qrcode, canvas)
-            score = fut.result()
+        # Each module is a 4x4 block. Sampling the center pixel of each block
+        # recovers the essential size without resampling.
+        canvas = Image.fromarray(gray[2::4, 2::4])
+
+        try:
+            score = eval_pool.submit(eval_qrcode, canvas).result()
+        except BrokenProcessPool as exc:
+            print(f'Evaluator crashed: {exc!r}')
+            stop_event.set()
+            break
 
         filename = f'{name}-{score}-m{mask}o{orient}s{seed}.png'
-        canvas.save(filename)
+        with canvas.convert('RGBA') as rgba:
+            rgba.save(filename)
         print(f'Saved: {filename} (score: {score}, url: {url})')
 
         if stop_if_found:
@@ -134,47 +314,68 @@ def search_qrcode(name: str,
 
 
 def eval_qrcode(qrcode: Image.Image) -> int:
+    """Scores a grayscale QR Code by how much JPEG compression it survives.
+    Readability is assumed to never drop as JPEG quality rises. Under that
+    assumption, the score is one more than the number of qualities from the
+    lowest readable one found up to 95, or 1 if even 95 is unreadable.
+    """
     assert qrcode.width == QRCODE_SIZE[0] + QART_MARGIN*2
     assert qrcode.height == QRCODE_SIZE[1] + QART_MARGIN*2
 
+    # Scale up 10 times in the middle of a black area twice as large.
     w, h = qrcode.size
-    resized = qrcode.resize((w*10, h*10))
-    expanded = Image.new('RGBA', (w*20, h*20), (0, 0, 0, 0))
-    expanded.paste(resized, (w*5, h*5), mask=resized)
-    qrcode = expanded
-
-    success = 1
-    for quality in range(1, 95+1):
-        img = qrcode.convert('RGB')
+    pixels = np.zeros((h*20, w*20, 1), np.uint8)
+    resized = np.asarray(qrcode).repeat(10, axis=0).repeat(10, axis=1)
+    pixels[h*5:h*15, w*5:w*15, 0] = resized
 
+    def decodes(quality: int) -> bool:
         # Compress as JPEG
-        buf = io.BytesIO()
-        img.save(buf, format='jpeg', quality=quality)
-        buf.seek(0)
-        img = Image.open(buf)
+        data = jpeg.encode(pixels, quality=quality, pixel_format=TJPF_GRAY,
+                           jpeg_subsample=TJSAMP_GRAY)
+        gray = jpeg.decode(data, pixel_format=TJPF_GRAY)
 
         # Decode
-        info = decode_barcode(img)
-        ok = (len(info) == 1 and info[0].type == 'QRCODE')
-        if ok:
-            success += 1
+        return is_qrcode(gray.reshape(gray.shape[:2]))
+
+    if not decodes(95):
+        return 1
+
+    # Higher quality is more likely to be readable. Binary search the lowest
+    # readable quality instead of trying all of them.
+    lo, hi = 1, 95
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if decodes(mid):
+            hi = mid
+        else:
+            lo = mid + 1
 
-    return success
+    return 1 + (95 - lo + 1)
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('design', type=argparse.FileType('rb'))
 parser.add_argument('href')
-parser.add_argument('-n', '--concurrency', type=int, default=16)
+parser.add_argument('-n', '--concurrency', type=int, default=32)
 parser.add_argument('-x', '--stop-if-found', action='store_true')
+parser.add_argument('-v', '--verbose', action='store_true')
 
 
 def main(name: str,
          design_file: IO[bytes],
          href: str,
-         concurrency: int = 16,
+         concurrency: int = 32,
          stop_if_found: bool = False,
+         verbose: bool = False,
          ) -> None:
+    # Keep a connection alive for every network thread. A smaller pool would
+    # discard the extra connections.
+    session.mount('https://', HTTPAdapter(
+        pool_maxsize=concurrency,
+        max_retries=Retry(total=2, backoff_factor=0.1,
+                          status_forcelist=(500, 502, 503, 504)),
+    ))
+
     with design_file, Image.open(design_file) as design:
         desired, necessary = split_design(design)
 
@@ -182,12 +383,45 @@ def main(name: str,
         desired.save(f, format='PNG')
         uploaded_image_id = upload_image(f.name)
 
+    # QArt scales QR Codes up 4 times. Scale the necessary part in the same
+    # way once to paste it without resizing each QR Code.
+    with necessary:
+        necessary_mask = np.asarray(necessary)[..., 3] > 0
+        necessary_pixels = np.asarray(necessary.convert('L'))
+    necessary_pixels = necessary_pixels.repeat(4, axis=0).repeat(4, axis=1)
+    necessary_mask = necessary_mask.repeat(4, axis=0).repeat(4, axis=1)
+    necessary_pixels.flags.writeable = False
+    necessary_mask.flags.writeable = False
+
     stop_event = Event()
-    ex = ThreadPoolExecutor()
+
+    # Fetching QR Codes waits for the network mostly. Decoding them is
+    # CPU-bound. Run them in separate pools so that both overlap.
+    cpu_count = os.cpu_count() or 1
+    trials = TrialQueue(cpu_count, maxsize=64)
+
+    # Decoding QR Codes is CPU-bound. Run it in processes to escape the GIL.
+    # The processes come from a fork server rather than forking this
+    # multi-threaded process.
+    mp_context = multiprocessing.get_context('forkserver')
+    decode_pool = ProcessPoolExecutor(cpu_count, mp_context=mp_context,
+                                      initializer=_init_worker)
+
+    # Evaluating found QR Codes is rare but CPU-intensive. Keep one warm
+    # process for the whole run.
+    eval_pool = ProcessPoolExecutor(1, mp_context=mp_context,
+                                    initializer=_init_worker)
+
+    net_ex = ThreadPoolExecutor(concurrency)
     for i in range(concurrency):
-        ex.submit(search_qrcode,
-                  name, href, uploaded_image_id, necessary,
-                  stop_event, stop_if_found)
+        net_ex.submit(fetch_qrcodes,
+                      href, uploaded_image_id, trials, stop_event, verbose)
+
+    cpu_ex = ThreadPoolExecutor(cpu_count)
+    for i in range(cpu_count):
+        cpu_ex.submit(search_qrcode,
+                      name, necessary_pixels, necessary_mask, trials, i,
+                      decode_pool, eval_pool, stop_event, stop_if_found)
 
     try:
         stop_event.wait()
@@ -195,8 +429,10 @@ def main(name: str,
         print('shutting down...')
     finally:
         stop_event.set()
-        ex.shutdown()
-        necessary.close()
+        net_ex.shutdown()
+        cpu_ex.shutdown()
+        decode_pool.shutdown()
+        eval_pool.shutdown()
 
 
 if __name__ == '__main__':
@@ -205,4 +441,5 @@ if __name__ == '__main__':
     name, png = os.path.splitext(os.path.basename(args.design.name))
     assert png.lower() == '.png'
 
-    main(name, args.design, args.href, args.concurrency, args.stop_if_found)
+    main(name, args.design, args.href, args.concurrency, args.stop_if_found,
+         args.verbose)